@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+#
+#  This script regenerates the _PROTOS table in gs1encoders.py from the
+#  function declarations in the C library header, so that the ctypes
+#  prototypes are kept in step with the native API.
+#
+#      ./build-protos.py ../../c-lib/gs1encoders.h gs1encoders.py
+#
+#  Only the functions already named in the table are regenerated. To bind an
+#  additional function, add its quoted name between the BEGIN and END markers
+#  and rerun the script.
+#
+
+import re
+import sys
+
+
+BEGIN = "# BEGIN PROTOS"
+END = "# END PROTOS"
+
+decl_rx = re.compile(r"""
+    ^GS1_ENCODERS_API \s+
+    (?:DEPRECATED \s+)?
+    (?P<ret>[^()]*?) \s*
+    \b(?P<name>gs1_encoder_\w+) \s*
+    \( (?P<params>[^()]*) \) \s* ;
+""", re.MULTILINE | re.VERBOSE)
+
+name_rx = re.compile(r'"(gs1_encoder_\w+)"')
+
+ctypes_for = {
+    "void": "None",
+    "bool": "ctypes.c_bool",
+    "int": "ctypes.c_int",
+    "size_t": "ctypes.c_size_t",
+    "char*": "ctypes.c_char_p",
+    "void*": "ctypes.c_void_p",
+    "gs1_encoder*": "_ctx_t",
+    "char***": "ctypes.POINTER(ctypes.POINTER(ctypes.c_char_p))",
+    "enum gs1_encoder_validations": "ctypes.c_int",
+}
+
+
+def c_type(decl, is_param):
+    decl = re.sub(r"\bconst\b", "", decl)
+    if is_param:
+        # Drop the parameter name
+        decl = re.sub(r"\b\w+\s*$", "", decl)
+    decl = re.sub(r"\s*\*\s*", "*", decl).strip()
+    decl = re.sub(r"\s+", " ", decl)
+    if decl not in ctypes_for:
+        raise ValueError("No ctypes mapping for C type '{}'".format(decl))
+    return ctypes_for[decl]
+
+
+def proto(ret, params):
+    params = params.strip()
+    if params in ("", "void"):
+        args = []
+    else:
+        args = [c_type(p, True) for p in params.split(",")]
+    argtypes = "({},)".format(args[0]) if len(args) == 1 else "({})".format(", ".join(args))
+    return c_type(ret, False), argtypes
+
+
+def main(header_file, binding_file):
+
+    with open(header_file) as f:
+        decls = {m["name"]: proto(m["ret"], m["params"]) for m in decl_rx.finditer(f.read())}
+
+    with open(binding_file) as f:
+        src = f.read()
+
+    start = src.index(BEGIN)
+    start = src.index("\n", start) + 1
+    end = src.index(END, start)
+    end = src.rindex("\n", 0, end) + 1
+
+    table = []
+    for name in name_rx.findall(src[start:end]):
+        if name not in decls:
+            sys.exit("{} is not declared in {}".format(name, header_file))
+        restype, argtypes = decls[name]
+        table.append('    ("{}", {}, {}),\n'.format(name, restype, argtypes))
+
+    with open(binding_file, "w") as f:
+        f.write(src[:start] + "_PROTOS = (\n" + "".join(table) + ")\n" + src[end:])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Usage: {} <gs1encoders.h> <gs1encoders.py>".format(sys.argv[0]))
+    main(sys.argv[1], sys.argv[2])
@@ -22,99 +22,250 @@
 #
 
 import ctypes
+import weakref
 
-class GS1Encoder:
-
-    __ctx = None
-    __api = ctypes.cdll.LoadLibrary("libgs1encoders.so")
+try:
+    from __pypy__ import add_memory_pressure as _add_memory_pressure
+except ImportError:
+    _add_memory_pressure = None
 
+# The encoder context is opaque so it is carried as a plain address
+_ctx_t = ctypes.c_void_p
 
-    __api.gs1_encoder_getVersion.argtypes = []
-    __api.gs1_encoder_getVersion.restype  = ctypes.c_char_p
+# Native functions used by the binding, as (name, restype, argtypes). Each is
+# installed as a module global named after the function without its
+# "gs1_encoder" prefix, e.g. _getDataStr.
+#
+# The table is generated from gs1encoders.h by build-protos.py.
+#
+# BEGIN PROTOS
+_PROTOS = (
+    ("gs1_encoder_getVersion", ctypes.c_char_p, ()),
+    ("gs1_encoder_instanceSize", ctypes.c_size_t, ()),
+    ("gs1_encoder_init", _ctx_t, (ctypes.c_void_p,)),
+    ("gs1_encoder_free", None, (_ctx_t,)),
+    ("gs1_encoder_getErrMsg", ctypes.c_char_p, (_ctx_t,)),
+    ("gs1_encoder_getIncludeDataTitlesInHRI", ctypes.c_bool, (_ctx_t,)),
+    ("gs1_encoder_setIncludeDataTitlesInHRI", ctypes.c_bool, (_ctx_t, ctypes.c_bool)),
+    ("gs1_encoder_getDataStr", ctypes.c_char_p, (_ctx_t,)),
+    ("gs1_encoder_setDataStr", ctypes.c_bool, (_ctx_t, ctypes.c_char_p)),
+    ("gs1_encoder_setAIdataStr", ctypes.c_bool, (_ctx_t, ctypes.c_char_p)),
+    ("gs1_encoder_getAIdataStr", ctypes.c_char_p, (_ctx_t,)),
+    ("gs1_encoder_getDLuri", ctypes.c_char_p, (_ctx_t, ctypes.c_char_p)),
+    ("gs1_encoder_getHRI", ctypes.c_int, (_ctx_t, ctypes.POINTER(ctypes.POINTER(ctypes.c_char_p)))),
+    ("gs1_encoder_getDLignoredQueryParams", ctypes.c_int, (_ctx_t, ctypes.POINTER(ctypes.POINTER(ctypes.c_char_p)))),
+)
+# END PROTOS
 
-    __api.gs1_encoder_init.argtypes = [ ctypes.POINTER(ctypes.c_void_p) ]
-    __api.gs1_encoder_init.restype  = ctypes.POINTER(ctypes.c_void_p)
+# Prebuilt arguments for c_bool parameters; ctypes passes an instance of
+# the declared type through without converting it
+_C_TRUE = ctypes.c_bool(True)
+_C_FALSE = ctypes.c_bool(False)
 
-    __api.gs1_encoder_free.argtypes = [ ctypes.POINTER(ctypes.c_void_p) ]
-    __api.gs1_encoder_free.restype  = None
+_api = None
 
-    __api.gs1_encoder_getErrMsg.argtypes = [ ctypes.POINTER(ctypes.c_void_p) ]
-    __api.gs1_encoder_getErrMsg.restype  = ctypes.c_char_p
+# The library is loaded and the prototypes instantiated on first use rather
+# than at import, so importing the module alone does not pay for it. Each
+# prototype is built once so that calls dispatch straight through the
+# prebuilt foreign function object.
+#
+# CFUNCTYPE prototypes release the GIL for the duration of each native call,
+# so separate GS1Encoder instances can process data concurrently from
+# multiple threads. As with the C library, an instance must not be shared
+# between threads.
+def _lazy_init():
+    global _api
+    if _api is not None:
+        return
+    api = ctypes.cdll.LoadLibrary("libgs1encoders.so")
+    g = globals()
+    for name, restype, argtypes in _PROTOS:
+        g[name.replace("gs1_encoder", "", 1)] = ctypes.CFUNCTYPE(restype, *argtypes)((name, api))
+    _api = api
 
-    __api.gs1_encoder_setIncludeDataTitlesInHRI.argtypes = [ ctypes.POINTER(ctypes.c_void_p), ctypes.c_bool ]
-    __api.gs1_encoder_setIncludeDataTitlesInHRI.restype  = ctypes.c_bool
 
-    __api.gs1_encoder_getDataStr.argtypes = [ ctypes.POINTER(ctypes.c_void_p) ]
-    __api.gs1_encoder_getDataStr.restype  = ctypes.c_char_p
+class GS1Encoder:
 
-    __api.gs1_encoder_setDataStr.argtypes = [ ctypes.POINTER(ctypes.c_void_p), ctypes.c_char_p ]
-    __api.gs1_encoder_setDataStr.restype  = ctypes.c_bool
+    # String inputs (data, AI data, DL URI stem) may be given as str or as
+    # bytes; bytes are passed through to the native library without encoding.
+    # Likewise the *_bytes getters return the native result without decoding
+    # it, for callers that pass the value on as bytes or back into a setter.
 
-    __api.gs1_encoder_getAIdataStr.argtypes = [ ctypes.POINTER(ctypes.c_void_p) ]
-    __api.gs1_encoder_getAIdataStr.restype  = ctypes.c_char_p
+    # No per-instance __dict__; only the native context, its finalizer and
+    # the reusable out-pointer for string arrays are held
+    __slots__ = ("_ctx", "_finalizer", "_out_ptr", "_out_ref", "__weakref__")
 
-    __api.gs1_encoder_getHRI.argtypes = [ ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.POINTER(ctypes.c_char_p)) ]
-    __api.gs1_encoder_getHRI.restype  = ctypes.c_int
+    _version = None
 
 
     def get_err_msg(self):
-        return self.__api.gs1_encoder_getErrMsg(self.__ctx).decode("utf-8")
+        return _getErrMsg(self._ctx).decode()
 
     def __init__(self):
-        self.__ctx = self.__api.gs1_encoder_init(None)
-        if self.__ctx == None:
+        self._ctx = None
+        _lazy_init()
+        self._ctx = _init(None)
+        if self._ctx is None:
             raise GS1EncoderGeneralException('Failed to initalise the native library')
 
-    def __del__(self):
-        self.free()
+        # The context is released by a finalizer rather than __del__; it runs
+        # at most once, from free(), on collection or at interpreter exit
+        self._finalizer = weakref.finalize(self, _free, self._ctx)
+
+        # Let PyPy's GC account for the native allocation it cannot see
+        if _add_memory_pressure is not None:
+            _add_memory_pressure(_instanceSize())
+
+        # The library unconditionally overwrites the out-pointer for the HRI
+        # and ignored query parameter arrays on each call, so a single one is
+        # allocated and reused
+        self._out_ptr = ctypes.POINTER(ctypes.c_char_p)()
+        self._out_ref = ctypes.byref(self._out_ptr)
 
     def free(self):
-        self.__api.gs1_encoder_free(self.__ctx)
-        self.__ctx = None
+        if self._ctx is None:
+            return
+        self._finalizer()
+        self._ctx = None
 
+    # The version is fixed for the lifetime of the loaded library
     def get_version(self):
-        return self.__api.gs1_encoder_getVersion().decode("utf-8")
+        cls = type(self)
+        if cls._version is None:
+            cls._version = _getVersion().decode()
+        return cls._version
 
     def set_include_data_titles_in_hri(self, value):
-        ret = self.__api.gs1_encoder_setIncludeDataTitlesInHRI(self.__ctx, 1 if value else 0)
+        ret = _setIncludeDataTitlesInHRI(self._ctx, _C_TRUE if value else _C_FALSE)
         if not ret:
-            raise GS1EncoderParameterException(self.get_err_msg())
+            raise GS1EncoderParameterException(_getErrMsg(self._ctx))
 
     def get_include_data_titles_in_hri(self):
-        return self.__api.gs1_encoder_getIncludeDataTitlesInHRI(self.__ctx) == 1
+        return _getIncludeDataTitlesInHRI(self._ctx)
 
     def get_data_str(self):
-        return self.__api.gs1_encoder_getDataStr(self.__ctx).decode("utf-8")
+        return _getDataStr(self._ctx).decode()
+
+    def get_data_bytes(self):
+        return _getDataStr(self._ctx)
 
     def set_data_str(self, value):
-        ret = self.__api.gs1_encoder_setDataStr(self.__ctx, value.encode("utf-8"))
+        if isinstance(value, str):
+            value = value.encode()
+        ret = _setDataStr(self._ctx, value)
         if not ret:
-            raise GS1EncoderParameterException(self.get_err_msg())
+            raise GS1EncoderParameterException(_getErrMsg(self._ctx))
 
     def get_ai_data_str(self):
-        ret = self.__api.gs1_encoder_getAIdataStr(self.__ctx)
-        if not ret:
+        ret = _getAIdataStr(self._ctx)
+        if ret is None:
             return None
-        return ret.decode("utf-8")
+        return ret.decode()
 
+    def set_ai_data_str(self, value):
+        if isinstance(value, str):
+            value = value.encode()
+        ret = _setAIdataStr(self._ctx, value)
+        if not ret:
+            raise GS1EncoderParameterException(_getErrMsg(self._ctx))
+
+    def get_ai_data_bytes(self):
+        return _getAIdataStr(self._ctx)
+
+    # Returns a (uri, None) or (None, err_msg) tuple rather than raising, for
+    # callers that generate URIs in bulk and handle failures as values
+    def try_get_dl_uri(self, stem=None):
+        if isinstance(stem, str):
+            stem = stem.encode()
+        ret = _getDLuri(self._ctx, stem)
+        if ret is None:
+            return None, _getErrMsg(self._ctx).decode()
+        return ret.decode(), None
+
+    def get_dl_uri(self, stem=None):
+        if isinstance(stem, str):
+            stem = stem.encode()
+        ret = _getDLuri(self._ctx, stem)
+        if ret is None:
+            raise GS1EncoderDigitalLinkException(_getErrMsg(self._ctx))
+        return ret.decode()
+
+    # The string arrays are sliced from the out-pointer in a single pass
     def get_hri(self):
-        ptr = ctypes.pointer(ctypes.c_char_p())
-        size = self.__api.gs1_encoder_getHRI(self.__ctx, ctypes.byref(ptr))
-        hri = [None] * size
-        for i in range(size):
-            hri[i] = ptr[i].decode("utf-8")
-        return hri
+        size = _getHRI(self._ctx, self._out_ref)
+        return [h.decode() for h in self._out_ptr[:size]]
+
+    def get_dl_ignored_query_params(self):
+        size = _getDLignoredQueryParams(self._ctx, self._out_ref)
+        return [p.decode() for p in self._out_ptr[:size]]
+
+    # Processes a sequence of AI data strings using this encoder's context,
+    # returning a (data_str, hri) tuple for each. The native functions and
+    # the HRI out-pointer are bound to locals outside the loop.
+    def encode_many(self, ai_data_list):
+        ctx = self._ctx
+        set_ai = _setAIdataStr
+        get_data = _getDataStr
+        get_hri = _getHRI
+        ptr = self._out_ptr
+        ptr_ref = self._out_ref
+        out = []
+        for ai_data in ai_data_list:
+            if isinstance(ai_data, str):
+                ai_data = ai_data.encode()
+            if not set_ai(ctx, ai_data):
+                raise GS1EncoderParameterException(_getErrMsg(ctx))
+            size = get_hri(ctx, ptr_ref)
+            out.append((get_data(ctx).decode(), [h.decode() for h in ptr[:size]]))
+        return out
+
+    # Converts a sequence of data strings to their AI data strings using this
+    # encoder's context, giving None for any that is not GS1 AI data. As for
+    # encode_many, the native functions are bound to locals outside the loop.
+    def data_to_ai_many(self, data_list):
+        ctx = self._ctx
+        set_data = _setDataStr
+        get_ai = _getAIdataStr
+        out = []
+        for data in data_list:
+            if isinstance(data, str):
+                data = data.encode()
+            if not set_data(ctx, data):
+                raise GS1EncoderParameterException(_getErrMsg(ctx))
+            ai_data = get_ai(ctx)
+            out.append(None if ai_data is None else ai_data.decode())
+        return out
+
+    # Attribute-style access to the above. Each property's accessors are the
+    # methods themselves, so there is no intermediate call.
+    version = property(get_version)
+    err_msg = property(get_err_msg)
+    include_data_titles_in_hri = property(get_include_data_titles_in_hri, set_include_data_titles_in_hri)
+    data_str = property(get_data_str, set_data_str)
+    data_bytes = property(get_data_bytes, set_data_str)
+    ai_data_str = property(get_ai_data_str, set_ai_data_str)
+    ai_data_bytes = property(get_ai_data_bytes, set_ai_data_str)
+    hri = property(get_hri)
+    dl_ignored_query_params = property(get_dl_ignored_query_params)
+
 
+# Error messages may be raised as the raw bytes returned by the native
+# library, in which case they are only decoded when the message is rendered
+class _GS1EncoderException(Exception):
+    def __str__(self):
+        if len(self.args) == 1 and isinstance(self.args[0], bytes):
+            return self.args[0].decode(errors="replace")
+        return super().__str__()
 
-class GS1EncoderGeneralException(Exception):
+class GS1EncoderGeneralException(_GS1EncoderException):
     pass
 
-class GS1EncoderParameterException(Exception):
+class GS1EncoderParameterException(_GS1EncoderException):
     pass
 
-class GS1EncoderDigitalLinkException(Exception):
+class GS1EncoderDigitalLinkException(_GS1EncoderException):
     pass
 
-class GS1EncoderScanDataException(Exception):
+class GS1EncoderScanDataException(_GS1EncoderException):
     pass
 